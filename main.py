@@ -3,7 +3,7 @@ import logging
 
 from src.bot import SmartXMPPBot
 from src.settings import settings
-from src.utils import check_ollama_health
+from src.utils import check_ollama_health, close_session, warm_up_ollama_models
 
 
 async def main():
@@ -12,12 +12,22 @@ async def main():
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
     )
-    if not await check_ollama_health():
-        logging.error("Ollama не подключена. AI-агент не работает.")
-    bot = SmartXMPPBot(settings.BOT_JID, settings.BOT_PASSWORD, settings.MUC_ROOM, settings.BOT_NICK)
-    await bot.connect()
-    await asyncio.sleep(10)
-    await asyncio.Future()
+    warm_up: asyncio.Task | None = None
+    try:
+        if await check_ollama_health():
+            warm_up = asyncio.create_task(
+                warm_up_ollama_models(settings.AI_DEFAULT_MODEL, settings.AI_CODE_MODEL)
+            )
+        else:
+            logging.error("Ollama не подключена. AI-агент не работает.")
+        bot = SmartXMPPBot(settings.BOT_JID, settings.BOT_PASSWORD, settings.MUC_ROOM, settings.BOT_NICK)
+        await bot.connect()
+        await asyncio.sleep(10)
+        await asyncio.Future()
+    finally:
+        if warm_up and not warm_up.done():
+            warm_up.cancel()
+        await close_session()
 
 
 if __name__ == "__main__":
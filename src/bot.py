@@ -1,8 +1,10 @@
 import asyncio
 import hashlib
-import imghdr
+import json
 import logging
-from asyncio import Task
+import os
+import random
+import time
 from datetime import datetime
 from pathlib import Path
 from typing import Any, Literal
@@ -17,10 +19,11 @@ from slixmpp_omemo import XEP_0384
 
 from src.custom_omemo.plugin import XEP_0384Impl
 from src.enums import MessageType, PluginTypes
+from src.history import ChatHistory
 from src.mixins import TypingEffectMixin
 from src.services import LLMService
 from src.settings import settings
-from src.utils import check_ollama_health
+from src.utils import accumulate_streaming_response, cached_ollama_health
 
 register_plugin(XEP_0384Impl, name="XEP_0384Impl")
 
@@ -28,6 +31,24 @@ MessageTypeLiteral = Literal["chat", "error", "groupchat", "headline", "normal"]
 ChatStatesLiteral = Literal["composing", "active"]
 
 
+def _sniff_mime(data: bytes) -> str:
+    """Определить MIME-тип изображения по сигнатуре файла."""
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+def _hash_and_sniff(data: bytes) -> tuple[str, str]:
+    """Посчитать SHA-1 и MIME-тип аватара."""
+    return hashlib.sha1(data).hexdigest(), _sniff_mime(data[:16])
+
+
 class SmartXMPPBot(TypingEffectMixin, ClientXMPP):
     """Умный XMPP-Бот."""
 
@@ -35,31 +56,43 @@ class SmartXMPPBot(TypingEffectMixin, ClientXMPP):
         super().__init__(jid, password)
         self.room = JID(room)
         self.nick = nick
+        self._nick_lower = nick.lower()
         self.llm_service = LLMService()
 
         self.MAX_HISTORY_LENGTH: int = 10
+        self.HISTORY_SUMMARY_BATCH: int = 10
         self.MAX_RECONNECT_ATTEMPTS: int = 10
         self.DEFAULT_CONTEXT: str = "Контекста нет"
+        self.UNRECOVERABLE_DISCONNECT_REASONS: frozenset[str] = frozenset(
+            {"not-authorized", "conflict", "host-unknown"}
+        )
+        self.AVATAR_PATH: Path = Path("./static/avatar.jpg")
+        self.AVATAR_CACHE_PATH: Path = Path("./static/avatar.cache.json")
 
         self.reconnect_attempts: int = 0
-        self.message_history: list[dict[str, Any]] = []
-        self.last_response_time: datetime = datetime.now()
-        self.active_sessions: dict[str, Task] = {}
-        self.message_ids: dict[str, str] = {}
+        self._fatal_disconnect_reason: str | None = None
+        self._muc_encrypt_cache: set[JID] | None = None
+        self.message_history = ChatHistory(maxlen=self.MAX_HISTORY_LENGTH)
+        self.last_response_time: float = 0.0
+        self._avatar_cache: dict[str, Any] = self._load_avatar_cache()
+        self._avatar_published_mtime: int | None = None
+        self._last_ts_second: int = 0
+        self._last_ts_str: str = ""
+        self._pending_triage: list[tuple[ChatHistory, asyncio.Future[dict[str, Any]]]] = []
+        self._triage_flush_task: asyncio.Task[None] | None = None
+        self._summary_task: asyncio.Task[None] | None = None
 
         for plugin in [
             PluginTypes.SERVICE_DISCOVERY,
             PluginTypes.MULTI_USER_CHAT,
             PluginTypes.XMPP_PING,
-            PluginTypes.PUB_SUB,
             PluginTypes.CHAT_STATES,
             PluginTypes.USER_AVATARS,
-            PluginTypes.V_CARD,
         ]:
             self.register_plugin(plugin.value)
         self.register_plugin(
             PluginTypes.CUSTOM_OMEMO_ENCRYPTION.value,
-            {"json_file_path": "omemo_data.json"},
+            {"db_file_path": "omemo_data.db", "json_file_path": "omemo_data.json"},
             module=__name__,
         )
 
@@ -68,12 +101,20 @@ class SmartXMPPBot(TypingEffectMixin, ClientXMPP):
         self.add_event_handler("groupchat_message", self.muc_message)
         self.add_event_handler("session_end", self.handle_disconnect)
         self.add_event_handler("disconnected", self.handle_disconnect)
+        self.add_event_handler("failed_all_auth", self.handle_failed_auth)
+        self.add_event_handler("stream_error", self.handle_stream_error)
+        self.add_event_handler(f"muc::{self.room}::got_online", self._invalidate_muc_encrypt_cache)
+        self.add_event_handler(f"muc::{self.room}::got_offline", self._invalidate_muc_encrypt_cache)
 
     async def initialize(self, event: Any = None) -> None:
         """Инициализация бота."""
+        self.reconnect_attempts = 0
+        self._fatal_disconnect_reason = None
         await self.get_roster()
         self.send_presence()
-        await self.set_avatar(image_path="./static/avatar.jpg")
+        avatar_stat = self.AVATAR_PATH.stat() if self.AVATAR_PATH.exists() else None
+        if not avatar_stat or avatar_stat.st_mtime_ns != self._avatar_published_mtime:
+            await self.set_avatar(image_path=str(self.AVATAR_PATH))
         welcome_message = "AI-Бот запущен и готов к работе"
         logging.info(welcome_message)
         await self.send_message_admin(message=f"🤖 {welcome_message}!")
@@ -81,18 +122,44 @@ class SmartXMPPBot(TypingEffectMixin, ClientXMPP):
     async def handle_disconnect(self, event: Any = None) -> None:
         """Обработка отключения от сервера."""
         logging.warning("Соединение с сервером потеряно")
+        self.clear_all_typing()
+        self._invalidate_muc_encrypt_cache()
+        if self._triage_flush_task:
+            self._triage_flush_task.cancel()
+        if self._summary_task:
+            self._summary_task.cancel()
+        await self.plugin[
+            PluginTypes.CUSTOM_OMEMO_ENCRYPTION.value  # type: ignore[typeddict-item]
+        ].storage.aclose()
+        reason = self._fatal_disconnect_reason or (event if isinstance(event, str) else "")
+        if any(condition in reason for condition in self.UNRECOVERABLE_DISCONNECT_REASONS):
+            logging.error(f"Переподключение невозможно: {reason}")
+            return None
         if self.reconnect_attempts < self.MAX_RECONNECT_ATTEMPTS:
             self.reconnect_attempts += 1
-            wait_time = min(2**self.reconnect_attempts, 60)
+            jitter = random.uniform(-0.5, 0.5)
+            wait_time = min(2**self.reconnect_attempts * (1 + jitter), 60.0)
             logging.info(
                 f"Попытка переподключения {self.reconnect_attempts}/"
-                f"{self.MAX_RECONNECT_ATTEMPTS} через {wait_time} сек..."
+                f"{self.MAX_RECONNECT_ATTEMPTS} через {wait_time:.1f} сек..."
             )
             await asyncio.sleep(wait_time)
             self.reconnect()
         else:
             logging.error("Превышено максимальное количество попыток переподключения")
 
+    def handle_failed_auth(self, event: Any = None) -> None:
+        """Запомнить ошибку авторизации, чтобы не переподключаться."""
+        logging.error("Ошибка авторизации: проверьте BOT_JID и BOT_PASSWORD")
+        self._fatal_disconnect_reason = "not-authorized"
+
+    def handle_stream_error(self, error: Any) -> None:
+        """Запомнить неустранимую ошибку потока, чтобы не переподключаться."""
+        condition = error["condition"]
+        logging.error(f"Ошибка потока XMPP: {condition}")
+        if condition in self.UNRECOVERABLE_DISCONNECT_REASONS:
+            self._fatal_disconnect_reason = condition
+
     async def set_avatar(self, image_path: str) -> None:
         """Установить аватар для бота."""
         try:
@@ -100,22 +167,55 @@ class SmartXMPPBot(TypingEffectMixin, ClientXMPP):
                 logging.error(f"Файл аватара не найден: {image_path}")
                 return None
 
-            with open(image_path, "rb") as f:
-                image_data = f.read()
+            stat = os.stat(image_path)
+            file_key = [stat.st_mtime_ns, stat.st_size]
+            image_data = await asyncio.to_thread(Path(image_path).read_bytes)
+            hash_task = None
+            if self._avatar_cache.get("file_key") != file_key:
+                hash_task = asyncio.create_task(asyncio.to_thread(_hash_and_sniff, image_data))
 
-            avatar_hash = hashlib.sha1(image_data).hexdigest()
-            image_type = imghdr.what(None, h=image_data)
-            mime_type = f"image/{image_type}" if image_type else "image/jpeg"
             await self.plugin[PluginTypes.USER_AVATARS.value].publish_avatar(  # type: ignore[typeddict-item]
                 data=image_data,
             )
+
+            if hash_task:
+                avatar_hash, mime_type = await hash_task
+                self._avatar_cache = {
+                    "file_key": file_key,
+                    "avatar_hash": avatar_hash,
+                    "mime_type": mime_type,
+                }
+                await asyncio.to_thread(self._save_avatar_cache)
+            else:
+                avatar_hash = self._avatar_cache["avatar_hash"]
+                mime_type = self._avatar_cache["mime_type"]
+
             metadata_items = AvatarMetadataItem(id=avatar_hash, type=mime_type, bytes=len(image_data))
             await self.plugin[
                 PluginTypes.USER_AVATARS.value  # type: ignore[typeddict-item]
             ].publish_avatar_metadata(items=metadata_items)
+            self._avatar_published_mtime = stat.st_mtime_ns
         except Exception as e:
             logging.error(f"Произошла ошибка при установке аватара: {e}")
 
+    def _load_avatar_cache(self) -> dict[str, Any]:
+        """Загрузить закэшированные данные аватара."""
+        try:
+            with open(self.AVATAR_CACHE_PATH, encoding="utf8") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def _save_avatar_cache(self) -> None:
+        """Атомарно сохранить данные аватара в кэш."""
+        tmp_path = self.AVATAR_CACHE_PATH.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf8") as f:
+                json.dump(self._avatar_cache, f)
+            os.replace(tmp_path, self.AVATAR_CACHE_PATH)
+        except Exception as e:
+            logging.warning(f"Не удалось сохранить кэш аватара: {e}")
+
     async def join_muc_room(self, event: Any = None) -> None:
         """Подключиться к группе."""
         logging.info("Бот online, присоединяюсь к комнате...")
@@ -169,8 +269,8 @@ class SmartXMPPBot(TypingEffectMixin, ClientXMPP):
             room_users = self.plugin[
                 PluginTypes.MULTI_USER_CHAT.value  # type: ignore[typeddict-item]
             ].get_roster(self.room)
-            if room_users:
-                mention_text = ", ".join([f"{nick}" for nick in room_users if nick != self.nick])
+            mention_text = ", ".join(nick for nick in room_users or () if nick.lower() != self._nick_lower)
+            if mention_text:
                 message = f"{mention_text}\n{message}"
 
         if is_encrypt:
@@ -234,11 +334,13 @@ class SmartXMPPBot(TypingEffectMixin, ClientXMPP):
                 logging.info(too_soon_message)
                 return None
 
-            if not await check_ollama_health():
+            if not await cached_ollama_health():
                 await self.send_debug_message(message="Ollama не подключена", is_reply_admin=True)
                 return None
 
-            should_respond, reason = await self.llm_service.analyze_conversation(self.message_history)
+            history = self.message_history.copy()
+            analysis = await self._queue_triage(history)
+            should_respond, reason = analysis["should_respond"], analysis["reason"]
             logging.debug(f"Решение анализа: {should_respond} - {reason}")
 
             if not should_respond:
@@ -247,37 +349,45 @@ class SmartXMPPBot(TypingEffectMixin, ClientXMPP):
                 logging.debug(reason_message)
                 return None
 
+            if self.llm_service.response_in_flight.is_set():
+                busy_message = "Предыдущий ответ ещё генерируется, пропускаю"
+                await self.send_debug_message(message=busy_message)
+                logging.info(busy_message)
+                return None
+
             await self.send_debug_message(message=f"Причина ответа:\n\n{reason}")
 
             try:
                 await self.send_chat_state(state="composing")
-                context = await self.llm_service.analyze_context(self.message_history)
-
+                context = analysis["context"]
+                code = {"is_programming": analysis["is_programming"], "confidence": analysis["confidence"]}
                 if not context:
                     logging.error("Контекста нет.")
                     context = self.DEFAULT_CONTEXT
 
                 await self.send_debug_message(message=f"Контекст беседы:\n\n{context}")
-                code = await self.llm_service.detector_code(self.message_history)
                 await self.send_debug_message(
                     message=f"Детектор кода:\n\n{code}",
                     is_reply_admin=True,
                 )
-                if code and code.get("is_programming"):
-                    response = await self.llm_service.generate_code_response(self.message_history)
+                if code["is_programming"]:
+                    chunks = self.llm_service.generate_code_response(history)
                 else:
-                    response = await self.llm_service.generate_response(  # type: ignore[assignment]
-                        conversation_history=self.message_history, context=context or self.DEFAULT_CONTEXT
+                    chunks = self.llm_service.generate_response(
+                        conversation_history=history, context=context or self.DEFAULT_CONTEXT
                     )
-                if response:
-                    self._add_to_history(body=response, sender=self.nick)
-                    logging.info("Ответ сгенерирован! Отправляю...")
+                if settings.ENABLE_TYPING_EFFECT:
                     await self.send_chat_state(state="active")
-                    if settings.ENABLE_TYPING_EFFECT:
-                        await self.send_message_with_typing(text=response, to_jid=self.room)
-                    else:
+                    response = await self.send_stream_with_typing(chunks=chunks, to_jid=self.room)
+                else:
+                    response = await accumulate_streaming_response(chunks)
+                    if response:
+                        logging.info("Ответ сгенерирован! Отправляю...")
+                        await self.send_chat_state(state="active")
                         await self.send_msg(message=response)
-                    self.last_response_time = datetime.now()
+                if response:
+                    self._add_to_history(body=response, sender=self.nick)
+                    self.last_response_time = asyncio.get_running_loop().time()
                 else:
                     logging.warning("LLM не сгенерировал ответ")
             except Exception as e:
@@ -340,15 +450,22 @@ class SmartXMPPBot(TypingEffectMixin, ClientXMPP):
 
     def get_encrypt_for_muc(self) -> set[JID]:
         """Получить множество JID, для кого нужно шифровать сообщение."""
+        if self._muc_encrypt_cache is not None:
+            return self._muc_encrypt_cache
         xep_0045 = self.plugin[PluginTypes.MULTI_USER_CHAT.value]  # type: ignore[typeddict-item]
         encrypt_for: set[JID] = set()
         for nick in xep_0045.get_roster(self.room):
-            if nick.lower() != self.nick.lower() and (
+            if nick.lower() != self._nick_lower and (
                 jid_property := xep_0045.get_jid_property(self.room, nick, "jid")
             ):
                 encrypt_for.add(JID(jid_property))
+        self._muc_encrypt_cache = encrypt_for
         return encrypt_for
 
+    def _invalidate_muc_encrypt_cache(self, event: Any = None) -> None:
+        """Сбросить кэш получателей шифрования при изменении состава комнаты."""
+        self._muc_encrypt_cache = None
+
     @staticmethod
     def _add_replace_elem(message: Message, replace_msg_id: str) -> None:
         """Добавить пометку об изменении сообщения."""
@@ -357,20 +474,70 @@ class SmartXMPPBot(TypingEffectMixin, ClientXMPP):
         replace_elem.set("id", replace_msg_id)
         message.xml.append(replace_elem)
 
+    async def _queue_triage(self, history: ChatHistory) -> dict[str, Any]:
+        """Поставить переписку в очередь на анализ: пришедшие во время анализа сообщения идут пакетом."""
+        future: asyncio.Future[dict[str, Any]] = asyncio.get_running_loop().create_future()
+        self._pending_triage.append((history, future))
+        if self._triage_flush_task is None:
+            self._triage_flush_task = asyncio.create_task(self._flush_triage())
+        return await future
+
+    async def _flush_triage(self) -> None:
+        """Анализировать накопленные переписки пакетами, пока очередь не опустеет."""
+        pending: list[tuple[ChatHistory, asyncio.Future[dict[str, Any]]]] = []
+        try:
+            while self._pending_triage:
+                pending, self._pending_triage = self._pending_triage, []
+                try:
+                    results = await self.llm_service.triage_batch([history for history, _ in pending])
+                except Exception as e:
+                    for _, future in pending:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, future), result in zip(pending, results):
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            for _, future in pending + self._pending_triage:
+                future.cancel()
+            self._pending_triage = []
+            self._triage_flush_task = None
+
     def _add_to_history(self, body: str, sender: str) -> None:
         """Добавляет сообщение в историю."""
+        second = int(time.time())
+        if second != self._last_ts_second:
+            self._last_ts_str = datetime.fromtimestamp(second).strftime("%m-%d-%Y %H:%M:%S")
+            self._last_ts_second = second
         self.message_history.append(
             {
                 "sender": sender,
-                "text": body.replace(self.nick, ""),
-                "time": datetime.now().strftime(format="%m-%d-%Y %H:%M:%S"),
+                "text": body.replace(self.nick, "") if self.nick in body else body,
+                "time": self._last_ts_str,
             }
         )
+        if self.message_history.evicted_count >= self.HISTORY_SUMMARY_BATCH and self._summary_task is None:
+            self._summary_task = asyncio.create_task(self._update_history_summary())
 
-        if len(self.message_history) > self.MAX_HISTORY_LENGTH:
-            self.message_history.pop(0)
+    async def _update_history_summary(self) -> None:
+        """Сжать вышедшие из окна сообщения в сводку, которая подставляется перед историей."""
+        lines = self.message_history.take_evicted()
+        try:
+            self.message_history.summary = await self.llm_service.summarize(
+                summary=self.message_history.summary, lines=lines
+            )
+            logging.debug(f"Сводка истории: {self.message_history.summary}")
+        except asyncio.CancelledError:
+            self.message_history.restore_evicted(lines)
+            raise
+        except Exception as e:
+            self.message_history.restore_evicted(lines)
+            logging.warning(f"Не удалось обновить сводку истории: {e}")
+        finally:
+            self._summary_task = None
 
     def _too_soon_to_respond(self) -> bool:
         """Проверяет, не слишком ли рано для нового ответа."""
-        elapsed = datetime.now() - self.last_response_time
-        return elapsed.total_seconds() < settings.MIN_RESPONSE_INTERVAL_SECONDS
+        elapsed = asyncio.get_running_loop().time() - self.last_response_time
+        return elapsed < settings.MIN_RESPONSE_INTERVAL_SECONDS
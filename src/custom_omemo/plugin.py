@@ -11,6 +11,7 @@ from src.custom_omemo.storage import StorageImpl
 class XEP_0384Impl(XEP_0384):
     default_config = {
         "fallback_message": "This message is OMEMO encrypted.",
+        "db_file_path": None,
         "json_file_path": None,
     }
 
@@ -19,10 +20,13 @@ class XEP_0384Impl(XEP_0384):
         self.__storage: StorageImpl
 
     def plugin_init(self) -> None:
-        if not self.json_file_path:
-            raise Exception("JSON file path not specified.")
+        if not self.db_file_path:
+            raise Exception("Database file path not specified.")
 
-        self.__storage = StorageImpl(Path(self.json_file_path))
+        self.__storage = StorageImpl(
+            Path(self.db_file_path),
+            legacy_json_file_path=Path(self.json_file_path) if self.json_file_path else None,
+        )
         super().plugin_init()
 
     @property
@@ -1,32 +1,106 @@
-import json
+import asyncio
+import logging
+import sqlite3
 from pathlib import Path
+from typing import Any, Callable
 
+import ormsgpack
 from omemo import JSONType
 from omemo.storage import Just, Maybe, Nothing, Storage
 
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads  # type: ignore[assignment]
+
 
 class StorageImpl(Storage):
-    def __init__(self, json_file_path: Path) -> None:
+    SCHEMA_VERSION: int = 2
+
+    def __init__(self, db_file_path: Path, legacy_json_file_path: Path | None = None) -> None:
         super().__init__()
-        self.__json_file_path = json_file_path
-        self.__data: dict[str, JSONType] = {}
-        try:
-            with open(self.__json_file_path, encoding="utf8") as f:
-                self.__data = json.load(f)
-        except Exception:
-            pass
+        self.__db_file_path = db_file_path
+        self.__legacy_json_file_path = legacy_json_file_path
+        self.__connection: sqlite3.Connection | None = None
+        self.__lock = asyncio.Lock()
 
     async def _load(self, key: str) -> Maybe[JSONType]:
-        if key in self.__data:
-            return Just(self.__data[key])
-        return Nothing()
+        raw = await self.__execute(self._load_sync, key)
+        if raw is None:
+            return Nothing()
+        return Just(ormsgpack.unpackb(raw))
 
     async def _store(self, key: str, value: JSONType) -> None:
-        self.__data[key] = value
-        with open(self.__json_file_path, "w", encoding="utf8") as f:
-            json.dump(self.__data, f)
+        await self.__execute(self._store_sync, key, ormsgpack.packb(value))
 
     async def _delete(self, key: str) -> None:
-        self.__data.pop(key, None)
-        with open(self.__json_file_path, "w", encoding="utf8") as f:
-            json.dump(self.__data, f)
+        await self.__execute(self._delete_sync, key)
+
+    async def aclose(self) -> None:
+        """Закрыть соединение с базой. При следующем обращении оно откроется заново."""
+        async with self.__lock:
+            if self.__connection is not None:
+                connection, self.__connection = self.__connection, None
+                await asyncio.to_thread(connection.close)
+
+    async def __execute(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Выполнить запрос к SQLite в отдельном потоке."""
+        async with self.__lock:
+            return await asyncio.to_thread(func, *args)
+
+    def _load_sync(self, key: str) -> bytes | None:
+        row = self.__connect().execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _store_sync(self, key: str, value: bytes) -> None:
+        self.__connect().execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", (key, value))
+
+    def _delete_sync(self, key: str) -> None:
+        self.__connect().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.__connection is None:
+            is_new = not self.__db_file_path.exists()
+            connection = sqlite3.connect(self.__db_file_path, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+            if is_new:
+                self.__migrate_legacy_json(connection)
+            else:
+                self.__migrate_json_values(connection)
+            connection.execute(f"PRAGMA user_version={self.SCHEMA_VERSION}")
+            self.__connection = connection
+        return self.__connection
+
+    def __migrate_legacy_json(self, connection: sqlite3.Connection) -> None:
+        """Перенести данные из старого JSON-файла в базу."""
+        json_file_path = self.__legacy_json_file_path
+        if not json_file_path or not json_file_path.exists():
+            return
+        try:
+            data: dict[str, JSONType] = _loads(json_file_path.read_bytes())  # type: ignore[assignment]
+        except Exception as e:
+            logging.error(f"Не удалось прочитать данные OMEMO из {json_file_path}: {e}")
+            return
+        connection.execute("BEGIN")
+        connection.executemany(
+            "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+            ((key, ormsgpack.packb(value)) for key, value in data.items()),
+        )
+        connection.execute("COMMIT")
+        logging.info(f"Данные OMEMO перенесены из {json_file_path} в {self.__db_file_path}")
+
+    def __migrate_json_values(self, connection: sqlite3.Connection) -> None:
+        """Перекодировать значения, сохранённые в JSON, в MessagePack."""
+        (version,) = connection.execute("PRAGMA user_version").fetchone()
+        if version >= self.SCHEMA_VERSION:
+            return
+        rows = connection.execute("SELECT key, value FROM kv").fetchall()
+        connection.execute("BEGIN")
+        connection.executemany(
+            "UPDATE kv SET value = ? WHERE key = ?",
+            ((ormsgpack.packb(_loads(value)), key) for key, value in rows),
+        )
+        connection.execute("COMMIT")
+        logging.info(f"Значения OMEMO в {self.__db_file_path} перекодированы в MessagePack")
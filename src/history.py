@@ -0,0 +1,67 @@
+from collections import deque
+from itertools import islice
+from typing import Any, Iterator
+
+
+class ChatHistory:
+    """История сообщений чата с заранее отформатированными строками."""
+
+    def __init__(self, maxlen: int) -> None:
+        self.maxlen = maxlen
+        self._messages: deque[dict[str, Any]] = deque(maxlen=maxlen)
+        self._formatted: deque[str] = deque(maxlen=maxlen)
+        self._evicted: list[str] = []
+        self.summary: str = ""
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        return iter(self._messages)
+
+    def __getitem__(self, index: int) -> dict[str, Any]:
+        return self._messages[index]
+
+    def append(self, message: dict[str, Any]) -> None:
+        """Добавить сообщение и его отформатированную строку."""
+        if len(self._formatted) == self.maxlen:
+            self._evicted.append(self._formatted[0])
+        self._messages.append(message)
+        sender = message.get("sender", "Unknown")
+        text = message.get("text", "")
+        time = message.get("time", "")
+        self._formatted.append(f"{time} - {sender}: {text}")
+
+    @property
+    def evicted_count(self) -> int:
+        """Сколько сообщений вышло из окна истории и ещё не попало в сводку."""
+        return len(self._evicted)
+
+    def take_evicted(self) -> list[str]:
+        """Забрать строки сообщений, вышедших из окна истории."""
+        evicted, self._evicted = self._evicted, []
+        return evicted
+
+    def restore_evicted(self, lines: list[str]) -> None:
+        """Вернуть забранные строки, если сводку не удалось обновить."""
+        self._evicted[:0] = lines
+
+    def tail(self, n: int) -> str:
+        """Последние n сообщений в виде пронумерованного текста, со сводкой более ранних."""
+        if not self._formatted:
+            return "История пуста"
+        skipped = max(len(self._formatted) - n, 0)
+        lines = islice(self._formatted, skipped, None)
+        recent = "\n".join(f"{i}. {line}" for i, line in enumerate(lines, 1))
+        if not self.summary:
+            return recent
+        gap = f"(пропущено сообщений: {skipped})\n\n" if skipped else ""
+        return f"Сводка более ранней беседы: {self.summary}\n\n{gap}Последние сообщения:\n{recent}"
+
+    def copy(self) -> "ChatHistory":
+        """Снимок истории, не меняющийся при добавлении новых сообщений."""
+        history = ChatHistory(self.maxlen)
+        history._messages = self._messages.copy()
+        history._formatted = self._formatted.copy()
+        history.summary = self.summary
+        return history
@@ -1,8 +1,7 @@
 import asyncio
 import logging
-import random
 from asyncio import Task
-from typing import TYPE_CHECKING, Any, cast
+from typing import TYPE_CHECKING, Any, AsyncGenerator, cast
 
 from slixmpp import JID
 
@@ -13,22 +12,63 @@ if TYPE_CHECKING:
 class TypingEffectMixin:
     """Миксин для добавления эффекта печати к XMPP клиенту"""
 
+    MIN_EDIT_INTERVAL: float = 0.4
+
     def __init__(self, *args: Any, **kwargs: Any):
         self.active_sessions: dict[str, Task] = {}
         self.message_ids: dict[str, str] = {}
         super().__init__(*args, **kwargs)
 
-    async def send_message_with_typing(self, text: str, to_jid: JID, speed: float = 0.02) -> None:
-        """Отправить сообщение с эффектом печати."""
+    async def send_stream_with_typing(self, chunks: AsyncGenerator[str, None], to_jid: JID) -> str:
+        """Отправить сообщение по мере его генерации, возвращает полный текст."""
         session_id = str(to_jid)
         if session_id in self.active_sessions:
-            self.active_sessions[session_id].cancel()
-        task = asyncio.create_task(self._typing_task(text, to_jid, speed, session_id))
+            logging.warning("Пропускаю ответ: в чат уже выводится предыдущий")
+            await chunks.aclose()
+            return ""
+        task = asyncio.create_task(self._streaming_task(chunks, to_jid, session_id))
         self.active_sessions[session_id] = task
         try:
-            await task
+            return await task
         except asyncio.CancelledError:
-            pass
+            return ""
+
+    async def _streaming_task(self, chunks: AsyncGenerator[str, None], to_jid: JID, session_id: str) -> str:
+        """Асинхронная задача для вывода потокового ответа."""
+        msg_id: str | None = None
+        text = ""
+        try:
+            loop = asyncio.get_running_loop()
+            last_edit_time = loop.time()
+
+            async for chunk in chunks:
+                text += chunk
+                if not text.strip():
+                    continue
+                if msg_id is None:
+                    msg_id = await self._send_cursor(to_jid) or ""
+                    if msg_id:
+                        self.message_ids[session_id] = msg_id
+                    last_edit_time = loop.time()
+                elif msg_id and loop.time() - last_edit_time >= self.MIN_EDIT_INTERVAL:
+                    await self._edit_message(to_jid, msg_id, text.strip() + "█")
+                    last_edit_time = loop.time()
+
+            text = text.strip()
+            if text:
+                if msg_id:
+                    await self._edit_message(to_jid, msg_id, text)
+                else:
+                    await cast("SmartXMPPBot", self).send_msg(message=text, to=to_jid, is_encrypt=False)
+            return text
+        except (Exception, asyncio.CancelledError):
+            if msg_id:
+                await self._edit_message(to_jid, msg_id, text.strip())
+            raise
+        finally:
+            await chunks.aclose()
+            if self.active_sessions.get(session_id) is asyncio.current_task():
+                self._cleanup_session(session_id)
 
     async def _send_cursor(self, to_jid: JID) -> str | None:
         """Отправляет сообщение с курсором, возвращает его ID"""
@@ -47,47 +87,6 @@ class TypingEffectMixin:
             except Exception:
                 return None
 
-    async def _typing_task(self, text: str, to_jid: JID, speed: float, session_id: str) -> None:
-        """Асинхронная задача для эффекта печати."""
-        try:
-            msg_id = await self._send_cursor(to_jid)
-            if not msg_id:
-                return
-
-            self.message_ids[session_id] = msg_id
-            displayed_text = ""
-            words = text.split()
-
-            for i, word in enumerate(words):
-                if session_id not in self.active_sessions:
-                    break
-
-                displayed_text += word + " "
-                cursor = "█" if (i % 2) == 0 else "▌"
-                display = displayed_text.strip() + cursor
-
-                await self._edit_message(to_jid, msg_id, display)
-
-                base_delay = speed * len(word) * 0.5
-                variation = random.choice([0.85, 1.0, 1.15])
-                delay = base_delay * variation
-                punctuation_multiplier = 1.0
-                if any(word.endswith(p) for p in [".", "!", "?"]):
-                    punctuation_multiplier = 1.7
-                elif any(word.endswith(p) for p in [",", ";", ":"]):
-                    punctuation_multiplier = 1.3
-                delay *= punctuation_multiplier
-                delay = max(0.25, min(delay, 2.0))
-                await asyncio.sleep(delay)
-
-            if session_id in self.active_sessions:
-                await self._edit_message(to_jid, msg_id, text)
-
-        except Exception as e:
-            logging.error(f"Ошибка в эффекте печати: {e}")
-        finally:
-            self._cleanup_session(session_id)
-
     async def _edit_message(self, to_jid: JID, msg_id: str, new_body: str) -> None:
         """Редактирует существующее сообщение"""
         try:
@@ -116,3 +115,10 @@ class TypingEffectMixin:
             self._cleanup_session(session_id)
             return True
         return False
+
+    def clear_all_typing(self) -> None:
+        """Останавливает все сессии печати"""
+        for task in self.active_sessions.values():
+            task.cancel()
+        self.active_sessions.clear()
+        self.message_ids.clear()
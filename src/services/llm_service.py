@@ -1,47 +1,41 @@
 import asyncio
 import logging
 import random
-from typing import Any
+import re
+from functools import cached_property
+from typing import Any, AsyncGenerator
 
-from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
+from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import PromptTemplate
 from langchain_core.runnables import RunnablePassthrough
-from langchain_ollama import OllamaLLM
+from langchain_ollama import OllamaEmbeddings, OllamaLLM
 
+from src.history import ChatHistory
+from src.services.semantic_cache import SemanticCache
 from src.settings import settings
 
-
-class LLMService:
-    """Сервис для работы с LLM-моделями."""
-
-    def __init__(self):
-        self.llm_general = OllamaLLM(
-            model=settings.AI_DEFAULT_MODEL,
-            temperature=0.1,
-        )
-        self.llm_code = OllamaLLM(
-            model=settings.AI_CODE_MODEL,
-            temperature=0.1,
-        )
-        self.decision_chain = self._create_decision_chain()
-        self.context_chain = self._create_context_chain()
-        self.response_chain = self._create_response_chain()
-
-        self.code_detector_chain = self._create_code_detector_chain()
-        self.code_response_chain = self._create_code_response_chain()
-
-        self.is_generating = False
-        self.generation_lock = asyncio.Lock()
-
-    def _create_decision_chain(self):
-        """Создать цепочку для принятия решения отвечать или нет."""
-        prompt = PromptTemplate(
-            input_variables=["conversation"],
-            template="""{conversation}
-
-        You are an participant in this chat.
-
-        Should you say something?
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads  # type: ignore[assignment]
+
+_DECISION_RE = re.compile(r"^\s*(YES|NO|ДА|НЕТ|Y|N)\s*(?:\|\s*(.*))?$", re.IGNORECASE | re.DOTALL)
+_POS_SET = frozenset({"YES", "ДА", "Y"})
+_CODE_RE = re.compile(
+    r"```|\bdef \b|\bclass \b|\bimport \b|(?-i:SELECT |INSERT |UPDATE )|\bgit \b|Traceback|\.py\b|npm |pip ",
+    re.IGNORECASE,
+)
+_ADDRESS_RE = re.compile(r"\b(бот|ai[- ]?бот|ии|ai)\b", re.IGNORECASE)
+_JSON_OBJECT_RE = re.compile(r"\{.*\}", re.DOTALL)
+_TRIAGE_MAX_CONCURRENCY = 4
+_TRIAGE_HISTORY_SIZE = 5
+_JOIN_HINT = "Consider joining"
+
+_TRIAGE_PROMPT = PromptTemplate(
+    input_variables=["conversation", "should_intervene"],
+    template="""You are an participant in this chat. Analyze the conversation and its LAST message.
+
+        1. Should you say something?
 
         Answer YES if:
 
@@ -49,7 +43,7 @@ class LLMService:
         - Someone mentioned bot/AI/AI-бот
         - There's a question with "?"
         - Someone asks for help
-        - {should_intervene} (chance to join conversation)
+        - The chance to join conversation below says so
         - Can add useful information
 
         UP TO YOU:
@@ -64,91 +58,44 @@ class LLMService:
         IMPORTANT: If words "AI-бот", "Бот", "ИИ", "AI" appear in text - almost always YES!
         Be sociable! Participate when possible.
 
-        Answer ONLY in format: DECISION | REASON
-            DECISION: YES or NO
-            REASON: brief reason (3-5 words)
+        2. Describe the conversation:
+            topic: code/greeting/work/humor/other
+            type: question/statement/joke
+            mood: friendly/neutral/funny/serious/angry
+            theme: the topic of the conversation in a few words, in Russian
 
-        Examples answer:
-            YES | Contacted the bot
-            YES | Have a question
-            NO | Just joking
-        """,
-        )
-        return (
-            {
-                "conversation": RunnablePassthrough(),
-                "should_intervene": lambda x: "Consider joining"
-                if random.random() < 0.3
-                else "No special reason",
-            }
-            | prompt
-            | self.llm_general
-            | StrOutputParser()
-        )
-
-    def _create_context_chain(self):
-        """Создать цепочку для формирования контекста чата."""
-
-        prompt = PromptTemplate(
-            input_variables=["conversation"],
-            template="""Message: "{conversation}"
-
-            Analyze and respond in Russian BUT use this exact format:
-            Topic=[code/greeting/work/humor/other]
-            Type=[question/statement/joke]
-            Mood=[friendly/neutral/funny/serious/angry]
-            Theme= Write the topic of the conversation in a few words
-
-            DO NOT ADD ANY OTHER TEXT!
-
-            Example output:
-            Topic=greeting Type=question Mood=friendly Theme=Food Choices
-            Topic=code Type=question Mood=serious Theme=Python decorators
-            """,
-        )
-        return (
-            {
-                "conversation": RunnablePassthrough(),
-            }
-            | prompt
-            | self.llm_general
-            | StrOutputParser()
-        )
-
-    def _create_code_detector_chain(self):
-        """Определяет, связан ли вопрос с программированием"""
-        prompt = PromptTemplate(
-            input_variables=["message"],
-            template="""Analyze if this Russian message is about programming/coding/IT/DataBase/Git:
-
-        Message: "{message}"
+        3. Is the LAST message about programming/coding/IT/DataBase/Git?
 
         Answer with JSON ONLY:
         {{
+          "decision": "YES" or "NO",
+          "reason": brief reason (3-5 words),
+          "topic": "...",
+          "type": "...",
+          "mood": "...",
+          "theme": "...",
           "is_programming": true/false,
-          "confidence": 0.0-1.0,
+          "confidence": 0.0-1.0
         }}
 
-        Examples:
-        Message: "Что такое классы в Python?"
-        Response: {{"is_programming": true, "confidence": 0.95}}
+        Examples answer:
+        {{"decision": "YES", "reason": "Have a question", "topic": "code", "type": "question",
+          "mood": "serious", "theme": "Декораторы в Python", "is_programming": true, "confidence": 0.95}}
+        {{"decision": "NO", "reason": "Just joking", "topic": "humor", "type": "joke",
+          "mood": "funny", "theme": "Выбор еды", "is_programming": false, "confidence": 0.99}}
 
-        Message: "Какой сегодня день?"
-        Response: {{"is_programming": false, "confidence": 0.99}}
+        ---
+        Chance to join conversation: {should_intervene}
 
-        Message: "Почему не работает мой код?"
-        Response: {{"is_programming": true, "confidence": 0.98}}
+        CONVERSATION:
+        {conversation}
 
         Your JSON response:""",
-        )
-        return {"message": RunnablePassthrough()} | prompt | self.llm_general | JsonOutputParser()
+)
 
-    def _create_code_response_chain(self):
-        prompt = PromptTemplate(
-            input_variables=["question"],
-            template="""Ты эксперт по программированию. Отвечай НА РУССКОМ.
-
-            Вопрос: {question}
+_CODE_RESPONSE_PROMPT = PromptTemplate(
+    input_variables=["question"],
+    template="""Ты эксперт по программированию. Отвечай НА РУССКОМ.
 
             Правила ответа:
             1. Отвечай ТОЛЬКО на русском языке
@@ -156,24 +103,17 @@ class LLMService:
             3. Если нужен пример кода - приведи короткий
             4. Не повторяй вопрос
 
-            Твой ответ на русском:""",
-        )
-        return {"question": RunnablePassthrough()} | prompt | self.llm_code | StrOutputParser()
+            ---
+            Вопрос: {question}
 
-    def _create_response_chain(self):
-        """Создать цепочку для формирования ответа."""
+            Твой ответ на русском:""",
+)
 
-        prompt = PromptTemplate(
-            input_variables=["conversation", "context_analysis"],
-            template="""Ты - дружелюбный помощник в чате. Твоё имя - AI-бот.
+_RESPONSE_PROMPT = PromptTemplate(
+    input_variables=["conversation", "context_analysis"],
+    template="""Ты - дружелюбный помощник в чате. Твоё имя - AI-бот.
             С тобой общаются как с живым собеседником.
 
-            КОНТЕКСТ БЕСЕДЫ:
-            {context_analysis}
-
-            ПОСЛЕДНИЕ СООБЩЕНИЯ:
-            {conversation}
-
             ПРАВИЛА ОТВЕТА:
             1. Отвечай ЕСТЕСТВЕННО, как человек в беседе
             2. Отвечай Средними предложениями (3-4 предложения)
@@ -185,118 +125,294 @@ class LLMService:
 
             Всегда давай понятный и чёткий ответ!
 
+            ---
+            КОНТЕКСТ БЕСЕДЫ:
+            {context_analysis}
+
+            ПОСЛЕДНИЕ СООБЩЕНИЯ:
+            {conversation}
+
             Твой ответ строго на русском языке сплошным текстом:""",
+)
+
+_SUMMARY_PROMPT = PromptTemplate(
+    input_variables=["summary", "messages"],
+    template="""Сожми переписку чата в краткую сводку НА РУССКОМ.
+
+            Правила:
+            1. Не больше 2-3 предложений
+            2. Сохрани участников, темы и открытые вопросы
+            3. Объедини прежнюю сводку с новыми сообщениями
+            4. Без вступлений и префиксов
+
+            ---
+            ПРЕЖНЯЯ СВОДКА:
+            {summary}
+
+            НОВЫЕ СООБЩЕНИЯ:
+            {messages}
+
+            Новая сводка:""",
+)
+
+
+class LLMService:
+    """Сервис для работы с LLM-моделями."""
+
+    def __init__(self):
+        self.semantic_cache = (
+            SemanticCache(OllamaEmbeddings(model=settings.AI_EMBEDDING_MODEL, base_url=settings.OLLAMA_URL))
+            if settings.AI_EMBEDDING_MODEL
+            else None
         )
-        return (
-            {
-                "conversation": RunnablePassthrough(),
-                "context_analysis": RunnablePassthrough(),
-            }
-            | prompt
-            | self.llm_general
-            | StrOutputParser()
-        )
+        self.generation_lock = asyncio.Semaphore(1)
+        self.response_in_flight = asyncio.Event()
+
+    @cached_property
+    def llm_triage(self) -> OllamaLLM:
+        return self._create_llm(settings.AI_DEFAULT_MODEL, num_predict=160, format="json")
+
+    @cached_property
+    def llm_general(self) -> OllamaLLM:
+        return self._create_llm(settings.AI_DEFAULT_MODEL, num_predict=220)
+
+    @cached_property
+    def llm_code(self) -> OllamaLLM:
+        return self._create_llm(settings.AI_CODE_MODEL, num_predict=400)
+
+    @cached_property
+    def llm_summary(self) -> OllamaLLM:
+        return self._create_llm(settings.AI_DEFAULT_MODEL, num_predict=80)
+
+    @cached_property
+    def triage_chain(self):
+        return self._create_triage_chain()
+
+    @cached_property
+    def response_chain(self):
+        return self._create_response_chain()
+
+    @cached_property
+    def code_response_chain(self):
+        return self._create_code_response_chain()
+
+    @cached_property
+    def summary_chain(self):
+        return self._create_summary_chain()
 
     @staticmethod
-    def _format_conversation(messages: list[dict[str, Any]]) -> str:
-        """Форматирует список сообщений в текст"""
-        if not messages:
-            return "История пуста"
-
-        formatted = []
-        for i, msg in enumerate(messages, 1):
-            sender = msg.get("sender", "Unknown")
-            text = msg.get("text", "")
-            time = msg.get("time", "")
-            formatted.append(f"{i}. {time} - {sender}: {text}")
-
-        return "\n".join(formatted)
-
-    async def analyze_conversation(
-        self, conversation_history: list[dict[str, Any]]
-    ) -> tuple[bool | None, str]:
-        """Анализирует, нужно ли отвечать"""
-        if self.is_generating:
-            logging.warning("Пропускаю запрос: уже идет генерация ответа")
-            return None, "Пропускаю запрос: уже идет генерация ответа"
-        conv_text = self._format_conversation(conversation_history[-5:])
-        self.is_generating = True
-        logging.info(f"Анализ истории чата ({len(conversation_history)} сообщений)...")
-        decision_result = await self.decision_chain.ainvoke(conv_text)
-        self.is_generating = False
-        try:
-            if "|" in decision_result:
-                parts = decision_result.split("|", 2)
-                decision = parts[0].strip().upper()
-                reason = parts[1].strip() if len(parts) > 1 else "Нет причины"
-                if decision in ["YES", "ДА", "Y"]:
-                    return True, reason
-                else:
-                    return False, reason
-            else:
-                result_upper = decision_result.upper()
-                if any(word in result_upper for word in ["YES", "ДА", "Y"]):
-                    return True, "Автоматический анализ (YES найдено в тексте)"
-                else:
-                    return False, "Автоматический анализ (NO по умолчанию)"
-        except Exception as e:
-            logging.error(f"Ошибка парсинга решения: {e}, raw: {decision_result}")
-            return False, f"Ошибка парсинга: {str(e)[:50]}"
-
-    async def analyze_context(self, conversation_history: list[dict[str, Any]]) -> str | None:
-        if self.is_generating:
-            logging.warning("Пропускаю запрос: уже идет анализ контекста")
-            return None
-        conv_text = self._format_conversation(conversation_history[-3:])
-        logging.info("Анализ контекста...")
-        context_result = await self.context_chain.ainvoke(
-            {
-                "conversation": conv_text,
-            }
+    def _create_llm(model: str, **kwargs: Any) -> OllamaLLM:
+        """Создать клиент Ollama с общими параметрами."""
+        return OllamaLLM(
+            model=model,
+            base_url=settings.OLLAMA_URL,
+            temperature=0.1,
+            keep_alive=settings.OLLAMA_KEEP_ALIVE,
+            num_ctx=settings.OLLAMA_NUM_CTX,
+            **kwargs,
         )
-        logging.debug(f"Контекст LLM: {context_result}")
-        return context_result
-
-    async def detector_code(self, conversation_history: list[dict[str, Any]]) -> dict[str, Any] | None:
-        if self.is_generating:
-            logging.warning("Пропускаю запрос: уже идет анализ контекста")
-            return None
-        conv_text = self._format_conversation(conversation_history[-1:])
-        logging.info("Анализ контекста на код...")
-        context_result = await self.code_detector_chain.ainvoke(
+
+    def _create_triage_chain(self):
+        """Создать цепочку для анализа сообщения за один запрос: решение, контекст и код."""
+        return _TRIAGE_PROMPT | self.llm_triage
+
+    def _create_code_response_chain(self):
+        return {"question": RunnablePassthrough()} | _CODE_RESPONSE_PROMPT | self.llm_code | StrOutputParser()
+
+    def _create_response_chain(self):
+        """Создать цепочку для формирования ответа."""
+        return _RESPONSE_PROMPT | self.llm_general | StrOutputParser()
+
+    def _create_summary_chain(self):
+        """Создать цепочку для сжатия старых сообщений в сводку."""
+        return _SUMMARY_PROMPT | self.llm_summary | StrOutputParser()
+
+    async def summarize(self, summary: str, lines: list[str]) -> str:
+        """Дополняет сводку переписки сообщениями, вышедшими из окна истории"""
+        logging.info(f"Обновление сводки истории ({len(lines)} сообщений)...")
+        result = await self.summary_chain.ainvoke(
+            {"summary": summary or "Сводки пока нет", "messages": "\n".join(lines)}
+        )
+        return result.strip() or summary
+
+    async def triage(self, conversation_history: ChatHistory) -> dict[str, Any]:
+        """Анализирует переписку: нужно ли отвечать, контекст и связь с кодом"""
+        return (await self.triage_batch([conversation_history]))[0]
+
+    async def triage_batch(self, histories: list[ChatHistory]) -> list[dict[str, Any]]:
+        """Анализирует несколько переписок, отправляя в LLM один пакет запросов"""
+        results: list[dict[str, Any] | None] = [None] * len(histories)
+        llm_indexes = []
+        for index, conversation_history in enumerate(histories):
+            last_text = conversation_history[-1]["text"] if conversation_history else ""
+            if self._is_code_message(last_text) and self._is_addressed_message(last_text):
+                logging.debug("Анализ по регулярным выражениям, без LLM")
+                results[index] = {
+                    "should_respond": True,
+                    "reason": "regex fast-path",
+                    "context": None,
+                    "is_programming": True,
+                    "confidence": 0.99,
+                }
+            else:
+                llm_indexes.append(index)
+
+        if llm_indexes:
+            llm_results = await self._triage_with_llm([histories[index] for index in llm_indexes])
+            for index, triage in zip(llm_indexes, llm_results):
+                last_text = histories[index][-1]["text"] if histories[index] else ""
+                if self._is_addressed_message(last_text) and not triage["should_respond"]:
+                    triage["should_respond"] = True
+                    triage["reason"] = "Обращение к боту"
+                if self._is_code_message(last_text):
+                    if not triage["is_programming"]:
+                        triage["is_programming"] = True
+                        triage["reason"] = f"{triage['reason']}; код распознан по шаблону"
+                    triage["confidence"] = max(triage["confidence"], 0.99)
+                results[index] = triage
+        return results  # type: ignore[return-value]
+
+    @staticmethod
+    def _is_code_message(text: str) -> bool:
+        """Очевидно ли, что сообщение о программировании"""
+        return bool(_CODE_RE.search(text))
+
+    @staticmethod
+    def _is_addressed_message(text: str) -> bool:
+        """Очевидно ли, что на сообщение нужно ответить: обращение к боту"""
+        return bool(_ADDRESS_RE.search(text))
+
+    async def _triage_with_llm(self, histories: list[ChatHistory]) -> list[dict[str, Any]]:
+        """Анализирует переписки запросами к LLM, промахи кэша уходят одним пакетом"""
+        results: list[dict[str, Any] | None] = [None] * len(histories)
+        vectors: list[Any] = [None] * len(histories)
+        keyed = [index for index, conversation_history in enumerate(histories) if conversation_history]
+        if self.semantic_cache and keyed:
+            try:
+                embedded = await self.semantic_cache.embed_many(
+                    [self._semantic_key(histories[index]) for index in keyed]
+                )
+            except Exception as e:
+                logging.warning(f"Семантический кэш недоступен: {e}")
+                embedded = []
+            for index, vector in zip(keyed, embedded):
+                vectors[index] = vector
+                cached = self.semantic_cache.lookup(vector)
+                if cached and cached[0] == histories[index][-1]["text"]:
+                    logging.debug(f"Анализ из семантического кэша: {cached[1]}")
+                    results[index] = dict(cached[1])
+
+        pending = [index for index, result in enumerate(results) if result is None]
+        if not pending:
+            return results  # type: ignore[return-value]
+
+        payloads = [
             {
-                "conversation": conv_text,
+                "conversation": histories[index].tail(_TRIAGE_HISTORY_SIZE),
+                "should_intervene": _JOIN_HINT if random.random() < 0.3 else "No special reason",
             }
+            for index in pending
+        ]
+        logging.info(f"Анализ истории чата: запросов в пакете {len(pending)}...")
+        outputs = await self.triage_chain.abatch(
+            payloads, config={"max_concurrency": _TRIAGE_MAX_CONCURRENCY}, return_exceptions=True
         )
-        logging.debug(f"Code Detector from LLM: {context_result}")
-        return context_result
+        for index, payload, output in zip(pending, payloads, outputs):
+            if isinstance(output, BaseException):
+                logging.error(f"Ошибка анализа: {output}")
+                results[index] = self._normalize_triage({"reason": f"Ошибка анализа: {str(output)[:50]}"})
+                continue
+            logging.debug(f"Анализ LLM: {output}")
+            try:
+                parsed = self._parse_triage(output)
+            except ValueError as e:
+                logging.error(f"Ошибка парсинга анализа: {e}")
+                results[index] = self._normalize_triage({"reason": f"Ошибка парсинга: {str(e)[:50]}"})
+                continue
+            triage = self._normalize_triage(parsed)
+            is_hinted = payload["should_intervene"] == _JOIN_HINT
+            if self.semantic_cache and vectors[index] is not None and not is_hinted:
+                self.semantic_cache.insert(vectors[index], (histories[index][-1]["text"], triage))
+            results[index] = dict(triage)
+        return results  # type: ignore[return-value]
 
-    async def generate_code_response(self, conversation_history: list[dict[str, Any]]) -> str:
-        """Генерирует ответ на вопрос о коде"""
+    @staticmethod
+    def _semantic_key(conversation_history: ChatHistory) -> str:
+        """Текст окна анализа без времени сообщений: ключ семантического кэша"""
+        messages = list(conversation_history)[-_TRIAGE_HISTORY_SIZE:]
+        return "\n".join(f"{message['sender']}: {message['text']}" for message in messages)
 
-        logging.debug(f"Использование {settings.AI_CODE_MODEL} для генерации ответа...")
-        last_message = conversation_history[-1]["text"]
-        response = await self.code_response_chain.ainvoke(last_message)
-        return response
+    @staticmethod
+    def _parse_triage(raw: str) -> dict[str, Any]:
+        """Разбирает JSON-ответ LLM без валидации схемы"""
+        try:
+            data = _loads(raw)
+        except ValueError:
+            match = _JSON_OBJECT_RE.search(raw)
+            if not match:
+                raise
+            data = _loads(match.group(0))
+        if not isinstance(data, dict):
+            raise ValueError(f"Ожидался JSON-объект, получено: {type(data).__name__}")
+        return data
+
+    @staticmethod
+    def _normalize_triage(result: dict[str, Any]) -> dict[str, Any]:
+        """Приводит ответ LLM к единому виду"""
+        match = _DECISION_RE.match(str(result.get("decision", "")))
+        context_fields = [result.get(field) for field in ("topic", "type", "mood", "theme")]
+        context = None
+        if any(context_fields):
+            topic, message_type, mood, theme = context_fields
+            context = f"Topic={topic} Type={message_type} Mood={mood} Theme={theme}"
+        try:
+            confidence = float(result.get("confidence", 0.0))
+        except (TypeError, ValueError):
+            confidence = 0.0
+        return {
+            "should_respond": match is not None and match.group(1).upper() in _POS_SET,
+            "reason": str(result.get("reason") or (match and match.group(2)) or "Нет причины"),
+            "context": context,
+            "is_programming": bool(result.get("is_programming")),
+            "confidence": confidence,
+        }
+
+    async def generate_code_response(self, conversation_history: ChatHistory) -> AsyncGenerator[str, None]:
+        """Генерирует ответ на вопрос о коде по частям"""
+
+        if self.response_in_flight.is_set():
+            logging.warning("Пропускаю запрос: уже идет генерация ответа")
+            return
+
+        self.response_in_flight.set()
+        try:
+            async with self.generation_lock:
+                logging.debug(f"Использование {settings.AI_CODE_MODEL} для генерации ответа...")
+                last_message = conversation_history[-1]["text"]
+                async for chunk in self.code_response_chain.astream(last_message):
+                    yield chunk
+        finally:
+            self.response_in_flight.clear()
+            logging.info("Генерация ответа завершена")
 
     async def generate_response(
-        self, conversation_history: list[dict[str, Any]], context: str | None
-    ) -> str | None:
-        """Генерирует ответ после положительного анализа."""
+        self, conversation_history: ChatHistory, context: str | None
+    ) -> AsyncGenerator[str, None]:
+        """Генерирует ответ по частям после положительного анализа."""
 
-        if self.is_generating:
+        if self.response_in_flight.is_set():
             logging.warning("Пропускаю запрос: уже идет генерация ответа")
-            return None
+            return
 
-        async with self.generation_lock:
-            try:
+        self.response_in_flight.set()
+        try:
+            async with self.generation_lock:
                 logging.debug(f"Использование {settings.AI_DEFAULT_MODEL} для генерации ответа...")
-                self.is_generating = True
-                conv_text = self._format_conversation(conversation_history[-3:])
-                response = await self.response_chain.ainvoke(
+                conv_text = conversation_history.tail(3)
+                async for chunk in self.response_chain.astream(
                     {"conversation": conv_text, "context_analysis": context}
-                )
-                return response
-            finally:
-                self.is_generating = False
-                logging.info("Генерация ответа завершена")
+                ):
+                    yield chunk
+        finally:
+            self.response_in_flight.clear()
+            logging.info("Генерация ответа завершена")
@@ -0,0 +1,55 @@
+from typing import Any
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+class SemanticCache:
+    """Семантический кэш ответов LLM: возвращает ответ для похожих по смыслу сообщений."""
+
+    def __init__(self, embeddings: Embeddings, threshold: float = 0.92, max_size: int = 512) -> None:
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_size = max_size
+        self._vectors: np.ndarray | None = None
+        self._values: list[Any] = []
+        self._last_used = np.zeros(max_size, dtype=np.int64)
+        self._tick = 0
+
+    async def embed(self, text: str) -> np.ndarray:
+        """Получить нормированный эмбеддинг текста."""
+        vector = np.asarray(await self.embeddings.aembed_query(text), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    async def embed_many(self, texts: list[str]) -> list[np.ndarray]:
+        """Получить нормированные эмбеддинги нескольких текстов одним запросом."""
+        vectors = np.asarray(await self.embeddings.aembed_documents(texts), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return list(np.divide(vectors, norms, out=vectors.copy(), where=norms > 0))
+
+    def lookup(self, vector: np.ndarray) -> Any | None:
+        """Найти сохранённый ответ для ближайшего по косинусной близости сообщения."""
+        if self._vectors is None or not self._values:
+            return None
+        similarities = self._vectors[: len(self._values)] @ vector
+        index = int(np.argmax(similarities))
+        if similarities[index] < self.threshold:
+            return None
+        self._tick += 1
+        self._last_used[index] = self._tick
+        return self._values[index]
+
+    def insert(self, vector: np.ndarray, value: Any) -> None:
+        """Сохранить ответ, вытесняя давно не использованную запись при переполнении."""
+        if self._vectors is None:
+            self._vectors = np.zeros((self.max_size, vector.shape[0]), dtype=np.float32)
+        if len(self._values) < self.max_size:
+            index = len(self._values)
+            self._values.append(value)
+        else:
+            index = int(np.argmin(self._last_used))
+            self._values[index] = value
+        self._vectors[index] = vector
+        self._tick += 1
+        self._last_used[index] = self._tick
@@ -10,7 +10,10 @@ class Settings(BaseSettings):
     MUC_ROOM: str
     AI_DEFAULT_MODEL: str
     AI_CODE_MODEL: str
+    AI_EMBEDDING_MODEL: str | None = None
     OLLAMA_URL: str
+    OLLAMA_KEEP_ALIVE: str = "60m"
+    OLLAMA_NUM_CTX: int = 2048
     IS_DEBUG: bool = False
     LOGGING_LEVEL: str = "INFO"
     ENABLE_TYPING_EFFECT: bool = True
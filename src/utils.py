@@ -1,21 +1,88 @@
+import asyncio
 import logging
+import time
+from typing import AsyncIterator
 
 import aiohttp
 
 from src.settings import settings
 
+_HEALTH_TTL = 5.0
+_health_cache: dict[str, float | bool] = {"ts": 0.0, "ok": False}
+_session: aiohttp.ClientSession | None = None
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """Возвращает общую HTTP-сессию с пулом keep-alive соединений"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=5),
+        )
+    return _session
+
+
+async def close_session() -> None:
+    """Закрывает общую HTTP-сессию"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
 
 async def check_ollama_health():
     """Проверяет доступность Ollama API"""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{settings.OLLAMA_URL}/api/tags", timeout=5) as response:
-                if response.status == 200:
-                    logging.info("Ollama запущен и доступен")
-                    return True
-                else:
-                    logging.error(f"Ollama вернул статус {response.status}")
-                    return False
+        session = await get_session()
+        async with session.get(f"{settings.OLLAMA_URL}/api/tags") as response:
+            if response.status == 200:
+                logging.info("Ollama запущен и доступен")
+                return True
+            else:
+                logging.error(f"Ollama вернул статус {response.status}")
+                return False
     except Exception as e:
         logging.error(f"❌ Не удалось подключиться к Ollama: {e}")
         return False
+
+
+async def warm_up_ollama_models(*models: str) -> None:
+    """Заранее загружает модели в память Ollama, чтобы первый ответ не ждал их загрузки"""
+
+    async def load(model: str) -> None:
+        try:
+            session = await get_session()
+            async with session.post(
+                f"{settings.OLLAMA_URL}/api/generate",
+                json={
+                    "model": model,
+                    "keep_alive": settings.OLLAMA_KEEP_ALIVE,
+                    "options": {"num_ctx": settings.OLLAMA_NUM_CTX},
+                },
+                timeout=aiohttp.ClientTimeout(total=300),
+            ) as response:
+                if response.status == 200:
+                    logging.info(f"Модель {model} загружена в Ollama")
+                else:
+                    logging.warning(f"Не удалось загрузить модель {model}: статус {response.status}")
+        except Exception as e:
+            logging.warning(f"Не удалось загрузить модель {model}: {e}")
+
+    await asyncio.gather(*(load(model) for model in dict.fromkeys(models)))
+
+
+async def cached_ollama_health() -> bool:
+    """Проверяет доступность Ollama API, кэшируя результат на несколько секунд"""
+    now = time.monotonic()
+    if _health_cache["ts"] and now - _health_cache["ts"] < _HEALTH_TTL:
+        return bool(_health_cache["ok"])
+    ok = await check_ollama_health()
+    _health_cache.update(ts=now, ok=ok)
+    return ok
+
+
+async def accumulate_streaming_response(chunks: AsyncIterator[str]) -> str:
+    """Собирает потоковый ответ LLM в одну строку"""
+    parts = [chunk async for chunk in chunks]
+    return "".join(parts).strip()